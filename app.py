@@ -1,6 +1,13 @@
+import io
+import time
+
 import streamlit as st
 from snowflake.snowpark.context import get_active_session
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import altair as alt
 
 # --- 1. PAGE CONFIGURATION (Must be the first command) ---
@@ -12,16 +19,172 @@ st.set_page_config(
 )
 
 # --- 2. DATA LOADING & CACHING ---
-# We cache the data loading to make the app feel faster when filtering
-@st.cache_data
+TABLE_NAME = "HEALTH_INVENTORY_DB.PUBLIC.INVENTORY_HEALTH_METRICS"
+
+# Arrow types of the loaded columns as setup.sql defines them. Every streamed chunk is cast
+# to this, so chunks always concatenate and an empty table still has a schema.
+LOAD_SCHEMA = pa.schema([
+    ('LOCATION_ID', pa.string()),
+    ('ITEM_NAME', pa.string()),
+    ('LAST_REPORT_DATE', pa.date32()),
+    ('CURRENT_STOCK', pa.int64()),
+    ('AVG_DAILY_USAGE', pa.float64()),
+    ('LEAD_TIME', pa.int64()),
+    ('DAYS_REMAINING', pa.float64()),
+    ('STATUS', pa.string()),
+    ('SUGGESTED_REORDER_QTY', pa.float64())
+])
+
+# The dashboard and the CSV export between them read every column of the table, so the
+# select below doesn't trim anything; it pins the column order LOAD_SCHEMA is cast to.
+DASHBOARD_COLUMNS = LOAD_SCHEMA.names
+
+# Columns each chart encodes. Charts get only these, so the Vega spec shipped
+# to the browser doesn't carry columns nothing reads.
+HEATMAP_COLUMNS = ['LOCATION_ID', 'ITEM_NAME', 'CURRENT_STOCK', 'DAYS_REMAINING', 'STATUS']
+RISK_COLUMNS = ['ITEM_NAME', 'DAYS_REMAINING', 'STATUS']
+SCATTER_COLUMNS = ['AVG_DAILY_USAGE', 'CURRENT_STOCK', 'STATUS', 'ITEM_NAME', 'LOCATION_ID']
+
+# Above this many points the scatter is binned into a SCATTER_BINS x SCATTER_BINS grid
+SCATTER_MAX_POINTS = 5000
+SCATTER_BINS = 40
+
+# Columns shown on the Procurement Desk
+ACTION_COLUMNS = ['LOCATION_ID', 'ITEM_NAME', 'CURRENT_STOCK', 'SUGGESTED_REORDER_QTY', 'STATUS', 'DAYS_REMAINING']
+
+# Columns in the downloadable PO list: everything that was loaded
+EXPORT_COLUMNS = DASHBOARD_COLUMNS
+
+# Status labels produced by setup.sql, most severe first
+STATUS_LEVELS = ['CRITICAL (Stockout Risk)', 'WARNING (Reorder Soon)', 'GOOD']
+
+# Low-cardinality text columns, held as dictionary codes from the moment they arrive
+LABEL_COLUMNS = ['LOCATION_ID', 'ITEM_NAME', 'STATUS']
+
+def encode_labels(tbl):
+    # Dictionary-encode the label columns of one streamed chunk, so full string
+    # columns never accumulate while the result streams in
+    tbl = tbl.cast(LOAD_SCHEMA)
+    for name in LABEL_COLUMNS:
+        i = tbl.schema.get_field_index(name)
+        tbl = tbl.set_column(i, name, pc.dictionary_encode(tbl.column(i)))
+    return tbl
+
+def bin_centers(values, bins):
+    # Snap each value to the center of one of `bins` equal-width bins (values must not be NaN)
+    values = values.to_numpy(dtype=float)
+    if not values.size:
+        return values
+    edges = np.linspace(np.nanmin(values), np.nanmax(values), bins + 1)
+    idx = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, bins - 1)
+    return (edges[idx] + edges[idx + 1]) / 2
+
+# We cache the data loading to make the app feel faster when filtering.
+# The dynamic table lags by about a minute (setup.sql), but the cached copy is only
+# reloaded every 5 minutes, so the dashboard may be up to 5 minutes stale; use Refresh Data for now.
+@st.cache_data(ttl=300)
 def load_data():
     session = get_active_session()
-    # Fetch the table
-    df_snow = session.table("HEALTH_INVENTORY_DB.PUBLIC.INVENTORY_HEALTH_METRICS")
-    return df_snow.to_pandas()
+    # Fetch the table, with columns in LOAD_SCHEMA order
+    df_snow = session.table(TABLE_NAME).select(DASHBOARD_COLUMNS)
+    # to_arrow_batches() yields pyarrow Tables, one per result chunk
+    chunks = [encode_labels(tbl) for tbl in df_snow.to_arrow_batches()]
+    if not chunks:
+        chunks = [encode_labels(LOAD_SCHEMA.empty_table())]
+    arrow_tbl = pa.concat_tables(chunks)
+    # The chunks share buffers with arrow_tbl; drop them so nothing else holds those buffers
+    del chunks
+    # self_destruct frees each Arrow column as soon as it is converted, keeping peak memory low.
+    # Dictionary columns arrive as categoricals, so filters and counts compare codes, not strings.
+    df = arrow_tbl.to_pandas(split_blocks=True, self_destruct=True)
+    # Categories come in arrival order; sort them so the sidebar lists them alphabetically
+    for col_name in ['LOCATION_ID', 'ITEM_NAME']:
+        df[col_name] = df[col_name].cat.reorder_categories(sorted(df[col_name].cat.categories))
+    # setup.sql's CASE ends in ELSE 'GOOD', so STATUS_LEVELS covers every label the table can hold.
+    # Unordered keeps the severity order for the sidebar while Altair still treats STATUS as nominal.
+    df['STATUS'] = df['STATUS'].astype(pd.CategoricalDtype(STATUS_LEVELS, ordered=False))
+    # The load timestamp identifies this snapshot in the derived caches below
+    return df, time.time()
+
+def to_csv_bytes(df):
+    # Arrow's C++ writer produces UTF-8 bytes directly, no intermediate Python string
+    buf = io.BytesIO()
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buf)
+    return buf.getvalue()
+
+# Everything the page shows is derived here once per filter selection, so a rerun with a
+# selection seen recently is a cache lookup. The leading underscore keeps Streamlit from
+# hashing the frame on every rerun; loaded_at stands in for it in the key. max_entries
+# bounds memory across many filter combinations and snapshots left behind by a refresh.
+# The result is a plain dict: st.cache_data pickles it, and a class defined in this script
+# is re-created on every run, so concurrent reruns can't pickle instances of it.
+@st.cache_data(ttl=300, max_entries=32, show_spinner=False)
+def derive(_df, loaded_at, loc_key, stat_key):
+    mask = _df['LOCATION_ID'].isin(frozenset(loc_key)) & _df['STATUS'].isin(frozenset(stat_key))
+    df = _df[mask]
+    
+    # One pass over STATUS gives every per-status count plus the row positions of each status
+    status_groups = df.groupby('STATUS', observed=True, sort=False)
+    status_counts = status_groups.size()
+    
+    # 999 marks "no usage" and counts as 0 days; subtract it out instead of building a replaced copy
+    # NULL DAYS_REMAINING (NULL stock or usage upstream) is skipped, as .mean() would
+    days = df['DAYS_REMAINING'].to_numpy(dtype=float)
+    known = np.count_nonzero(~np.isnan(days))
+    if known:
+        no_usage = np.count_nonzero(days == 999)
+        avg_coverage = round(float(np.nansum(days) - 999 * no_usage) / known, 1)
+    else:
+        avg_coverage = 0.0
+    
+    # setup.sql already groups the table by (LOCATION_ID, ITEM_NAME), so each row is one heatmap cell
+    heatmap_df = df.loc[:, HEATMAP_COLUMNS]
+    
+    risk_df = df.loc[:, RISK_COLUMNS]
+    if len(risk_df) > 5:
+        # Partial selection of the 5 smallest instead of sorting the whole frame
+        risk_df = risk_df.nsmallest(5, 'DAYS_REMAINING')
+    
+    if len(df) <= SCATTER_MAX_POINTS:
+        velocity_df = df.loc[:, SCATTER_COLUMNS]
+    else:
+        # Too many points to draw one by one: count them per grid cell here so the
+        # browser only renders at most SCATTER_BINS^2 circles per status
+        # Points with unknown usage or stock can't be placed; Vega drops them too
+        velocity_df = df.loc[:, ['AVG_DAILY_USAGE', 'CURRENT_STOCK', 'STATUS']].dropna(
+            subset=['AVG_DAILY_USAGE', 'CURRENT_STOCK']
+        )
+        velocity_df['AVG_DAILY_USAGE'] = bin_centers(velocity_df['AVG_DAILY_USAGE'], SCATTER_BINS)
+        velocity_df['CURRENT_STOCK'] = bin_centers(velocity_df['CURRENT_STOCK'], SCATTER_BINS)
+        velocity_df = velocity_df.groupby(
+            ['AVG_DAILY_USAGE', 'CURRENT_STOCK', 'STATUS'], observed=True, sort=False
+        ).size().reset_index(name='ITEM_COUNT')
+    
+    # Rows needing action, most severe status first, taken straight from the group positions
+    action_positions = [status_groups.indices[s] for s in STATUS_LEVELS if s != 'GOOD' and s in status_groups.indices]
+    action_rows = np.concatenate(action_positions) if action_positions else np.empty(0, dtype=np.intp)
+    action_df = df.iloc[action_rows, df.columns.get_indexer(ACTION_COLUMNS)]
+    export_df = df.iloc[action_rows, df.columns.get_indexer(EXPORT_COLUMNS)]
+    
+    # Scale the stock bars to the largest stock on screen (NaN when every stock is NULL)
+    top_stock = action_df['CURRENT_STOCK'].max()
+    max_stock = max(int(top_stock), 1) if pd.notna(top_stock) else 1
+    
+    return {
+        'total_items': len(df),
+        'critical_items': int(status_counts.get('CRITICAL (Stockout Risk)', 0)),
+        'warning_items': int(status_counts.get('WARNING (Reorder Soon)', 0)),
+        'avg_coverage': avg_coverage,
+        'heatmap_df': heatmap_df,    # one row per (location, item) cell
+        'risk_df': risk_df,          # the 5 items with the fewest days left
+        'velocity_df': velocity_df,  # scatter points, binned above SCATTER_MAX_POINTS
+        'action_df': action_df,      # procurement list, most severe status first
+        'csv': to_csv_bytes(export_df) if not export_df.empty else b'',
+        'max_stock': max_stock
+    }
 
 try:
-    df_raw = load_data()
+    df_raw, loaded_at = load_data()
 except:
     st.error("⚠️ Could not connect to Snowflake. Make sure you are running this inside Snowflake!")
     st.stop()
@@ -33,40 +196,37 @@ with st.sidebar:
     
     st.subheader("🔎 Filter View")
     
-    # Filter 1: Location
-    all_locations = sorted(df_raw['LOCATION_ID'].unique())
+    # Filter 1: Location (categories are already deduplicated and sorted)
+    all_locations = df_raw['LOCATION_ID'].cat.categories.tolist()
     selected_locations = st.multiselect("Select Locations", all_locations, default=all_locations)
     
-    # Filter 2: Status
-    all_statuses = sorted(df_raw['STATUS'].unique())
+    # Filter 2: Status (listed by severity)
+    all_statuses = df_raw['STATUS'].cat.categories.tolist()
     selected_statuses = st.multiselect("Filter by Status", all_statuses, default=all_statuses)
     
     st.markdown("---")
     st.caption("Last Refreshed: Just now")
     if st.button("🔄 Refresh Data"):
-        st.cache_data.clear()
-        st.experimental_rerun()
+        # Only the Snowflake pull is invalidated. derive() is keyed on the load
+        # timestamp, so the fresh snapshot gets fresh entries without a global clear.
+        load_data.clear()
+        st.rerun()
 
 # --- 4. DATA FILTERING LOGIC ---
-# Filter the dataframe based on sidebar inputs
-df_filtered = df_raw[
-    (df_raw['LOCATION_ID'].isin(selected_locations)) & 
-    (df_raw['STATUS'].isin(selected_statuses))
-]
+# Filter the dataframe based on sidebar inputs.
+# Sorted tuples make the cache key independent of the order options were picked in.
+loc_key = tuple(sorted(selected_locations))
+stat_key = tuple(sorted(selected_statuses))
+d = derive(df_raw, loaded_at, loc_key, stat_key)
 
 # --- 5. TOP LEVEL METRICS (KPIs) ---
 st.markdown("### 📊 Operational Overview")
 col1, col2, col3, col4 = st.columns(4)
 
-total_items = len(df_filtered)
-critical_items = len(df_filtered[df_filtered['STATUS'] == 'CRITICAL (Stockout Risk)'])
-warning_items = len(df_filtered[df_filtered['STATUS'] == 'WARNING (Reorder Soon)'])
-avg_coverage = round(df_filtered['DAYS_REMAINING'].replace(999, 0).mean(), 1)
-
-col1.metric("📦 Total SKUs Tracking", total_items)
-col2.metric("🚨 Critical Alerts", critical_items, delta="-Action Needed" if critical_items > 0 else "All Good", delta_color="inverse")
-col3.metric("⚠️ Reorder Warnings", warning_items, delta_color="off")
-col4.metric("📅 Avg Stock Coverage", f"{avg_coverage} Days")
+col1.metric("📦 Total SKUs Tracking", d['total_items'])
+col2.metric("🚨 Critical Alerts", d['critical_items'], delta="-Action Needed" if d['critical_items'] > 0 else "All Good", delta_color="inverse")
+col3.metric("⚠️ Reorder Warnings", d['warning_items'], delta_color="off")
+col4.metric("📅 Avg Stock Coverage", f"{d['avg_coverage']} Days")
 
 st.markdown("---")
 
@@ -77,9 +237,9 @@ tab_overview, tab_analysis, tab_action = st.tabs(["🌍 Global Heatmap", "📈 R
 with tab_overview:
     st.subheader("📍 Network-Wide Stock Health")
     
-    if not df_filtered.empty:
+    if d['total_items']:
         # Altair Heatmap with interactivity
-        heatmap = alt.Chart(df_filtered).mark_rect().encode(
+        heatmap = alt.Chart(d['heatmap_df']).mark_rect().encode(
             x=alt.X('LOCATION_ID', title='Location', axis=alt.Axis(labelAngle=-45)),
             y=alt.Y('ITEM_NAME', title='Item Name'),
             color=alt.Color('DAYS_REMAINING', scale=alt.Scale(scheme='redyellowgreen', domain=[0, 30]), title='Days Left'),
@@ -101,48 +261,57 @@ with tab_overview:
 
 # === TAB 2: RISK ANALYSIS CHARTS ===
 with tab_analysis:
-    col_a, col_b = st.columns(2)
+    if d['total_items']:
+        col_a, col_b = st.columns(2)
     
-    with col_a:
-        st.markdown("**📉 Top 5 Items at Risk (Lowest Days Remaining)**")
-        risk_df = df_filtered.sort_values('DAYS_REMAINING').head(5)
-        
-        bar_chart = alt.Chart(risk_df).mark_bar().encode(
-            x=alt.X('DAYS_REMAINING', title='Days Remaining'),
-            y=alt.Y('ITEM_NAME', sort='x', title=''),
-            color=alt.Color('STATUS', scale=alt.Scale(domain=['CRITICAL (Stockout Risk)', 'WARNING (Reorder Soon)', 'GOOD'], range=['#d62728', '#ff7f0e', '#2ca02c']))
-        )
-        st.altair_chart(bar_chart, use_container_width=True)
+        with col_a:
+            st.markdown("**📉 Top 5 Items at Risk (Lowest Days Remaining)**")
+            bar_chart = alt.Chart(d['risk_df']).mark_bar().encode(
+                x=alt.X('DAYS_REMAINING', title='Days Remaining'),
+                y=alt.Y('ITEM_NAME', sort='x', title=''),
+                color=alt.Color('STATUS', scale=alt.Scale(domain=STATUS_LEVELS, range=['#d62728', '#ff7f0e', '#2ca02c']))
+            )
+            st.altair_chart(bar_chart, use_container_width=True)
         
-    with col_b:
-        st.markdown("**🛒 Supply Velocity (Avg Daily Usage)**")
-        # Scatter plot to show which items move fastest
-        scatter = alt.Chart(df_filtered).mark_circle(size=100).encode(
-            x=alt.X('AVG_DAILY_USAGE', title='Daily Usage Rate'),
-            y=alt.Y('CURRENT_STOCK', title='Current Stock Level'),
-            color='STATUS',
-            tooltip=['ITEM_NAME', 'LOCATION_ID', 'AVG_DAILY_USAGE']
-        ).interactive()
-        st.altair_chart(scatter, use_container_width=True)
+        with col_b:
+            st.markdown("**🛒 Supply Velocity (Avg Daily Usage)**")
+            # Scatter plot to show which items move fastest
+            if 'ITEM_COUNT' not in d['velocity_df'].columns:
+                scatter = alt.Chart(d['velocity_df']).mark_circle(size=100).encode(
+                    x=alt.X('AVG_DAILY_USAGE', title='Daily Usage Rate'),
+                    y=alt.Y('CURRENT_STOCK', title='Current Stock Level'),
+                    color='STATUS',
+                    tooltip=['ITEM_NAME', 'LOCATION_ID', 'AVG_DAILY_USAGE']
+                ).interactive()
+            else:
+                # Binned points: one circle per grid cell and status, sized by item count
+                scatter = alt.Chart(d['velocity_df']).mark_circle().encode(
+                    x=alt.X('AVG_DAILY_USAGE', title='Daily Usage Rate'),
+                    y=alt.Y('CURRENT_STOCK', title='Current Stock Level'),
+                    color='STATUS',
+                    size=alt.Size('ITEM_COUNT', title='Items'),
+                    tooltip=['STATUS', alt.Tooltip('ITEM_COUNT', title='Items'), 'AVG_DAILY_USAGE']
+                ).interactive()
+            st.altair_chart(scatter, use_container_width=True)
+    else:
+        st.info("No data matches your filters.")
 
 # === TAB 3: PROCUREMENT DESK (ACTIONABLE TABLE) ===
 with tab_action:
     st.subheader("📝 Procurement Orders")
     
-    # Filter for items that need action
-    action_df = df_filtered[df_filtered['STATUS'] != 'GOOD'].copy()
-    
-    if not action_df.empty:
+    # Items that need action, precomputed in derive()
+    if not d['action_df'].empty:
         # Configure columns for a "Premium" look
         st.dataframe(
-            action_df[['LOCATION_ID', 'ITEM_NAME', 'CURRENT_STOCK', 'SUGGESTED_REORDER_QTY', 'STATUS', 'DAYS_REMAINING']],
+            d['action_df'],
             column_config={
                 "CURRENT_STOCK": st.column_config.ProgressColumn(
                     "Stock Level",
                     help="Visual representation of current stock",
                     format="%d",
                     min_value=0,
-                    max_value=1000, # Adjust based on your typical stock max
+                    max_value=d['max_stock'],
                 ),
                 "SUGGESTED_REORDER_QTY": st.column_config.NumberColumn(
                     "Reorder Qty",
@@ -157,10 +326,9 @@ with tab_action:
         )
         
         # Download Button
-        csv = action_df.to_csv(index=False).encode('utf-8')
         st.download_button(
             label="📥 Download Approved PO List (CSV)",
-            data=csv,
+            data=d['csv'],
             file_name='procurement_orders.csv',
             mime='text/csv',
             type="primary" # Makes the button blue/prominent